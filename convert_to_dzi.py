@@ -6,14 +6,27 @@ Keeps the original image for high-res crop export.
 Usage:
   python3 convert_to_dzi.py image.jpg
   python3 convert_to_dzi.py image.jpg --cleanup   # delete original after conversion
+  python3 convert_to_dzi.py image.jpg --tile-size 1024
+  python3 convert_to_dzi.py image.jpg --container fs   # loose tile files instead of a .zip
 """
 
+import os
 import sys
 import json
 import re
+import time
 import argparse
+import shutil
+from contextlib import contextmanager
 from pathlib import Path
 
+# libvips reads these once, when pyvips is imported. dzsave stops scaling
+# past a handful of threads and extra ones just contend, so cap the default
+# at 8; the higher disc threshold keeps more formats decoding in RAM. Both
+# also reach the vips CLI fallback through the environment.
+os.environ.setdefault("VIPS_CONCURRENCY", str(min(os.cpu_count() or 4, 8)))
+os.environ.setdefault("VIPS_DISC_THRESHOLD", "2g")
+
 try:
     import pyvips
     HAS_PYVIPS = True
@@ -21,17 +34,39 @@ except ImportError:
     HAS_PYVIPS = False
     import subprocess
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import fcntl
+except ImportError:  # Windows, metadata writes are still atomic but unlocked
+    fcntl = None
+
 from thumb_utils import get_or_generate_thumbnail
 
+# dzsave runs a pipeline per tile, so bigger tiles amortise that setup over
+# more pixels. OpenSeadragon reads the tile size from the .dzi, any value works.
+DEFAULT_TILE_SIZE = 512
+MAX_TILE_SIZE = 8192  # libvips' dzsave limit
+
+# "zip" packs the pyramid into a single {slug}.zip that serve.py reads tiles
+# out of; "fs" writes the classic {slug}.dzi + {slug}_files/ tree
+CONTAINERS = ("zip", "fs")
+DEFAULT_CONTAINER = "zip"
+
+
+_SLUG_STRIP = re.compile(r"[^\w\s-]")
+_SLUG_DASH = re.compile(r"[-\s]+")
+
 
 def _safe_slug(name):
     """Create a filesystem-safe slug from a name."""
     if not name:
         return "artwork"
-    slug = re.sub(r"[^\w\s-]", "", name)
-    slug = re.sub(r"[-\s]+", "-", slug)
-    slug = slug.lower().strip("-")
-    slug = re.sub(r"-+", "-", slug)
+    # dash runs are already collapsed, so stripping can't create new ones
+    slug = _SLUG_DASH.sub("-", _SLUG_STRIP.sub("", name)).lower().strip("-")
     return slug[:80] or "artwork"
 
 
@@ -46,16 +81,59 @@ def _safe_path(base_dir, *parts):
     return target
 
 
+_BAR_LEN = 40
+_BARS = ["█" * i + "░" * (_BAR_LEN - i) for i in range(_BAR_LEN + 1)]
+_PROGRESS_INTERVAL = 0.1
+
+
+def _copy_file(src, dst):
+    """Copy a file without pulling it through Python; reflinks where the filesystem can."""
+    if hasattr(os, "copy_file_range"):
+        copied = 0
+        try:
+            with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+                size = os.fstat(fsrc.fileno()).st_size
+                while copied < size:
+                    n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), size - copied)
+                    if not n:
+                        break
+                    copied += n
+            if copied == size:
+                return
+        except OSError:
+            # older kernels refuse cross-filesystem copies (EXDEV) or lack
+            # the syscall entirely; copyfile still uses sendfile there
+            if copied:
+                raise
+        if copied:
+            raise OSError(f"copy of {src} stopped at {copied} of {size} bytes")
+        # some filesystems report 0 bytes copied before EOF, start over
+    shutil.copyfile(src, dst)
+
+
 def show_progress(image, progress):
-    bar_len = 40
-    filled = int(bar_len * progress.percent / 100)
-    bar = "█" * filled + "░" * (bar_len - filled)
+    # eval fires for every region dzsave computes, far more often than anyone
+    # can read, so only redraw when the percentage moves or every 100ms
+    now = time.monotonic()
+    if (progress.percent == show_progress.last_percent
+            and now - show_progress.last < _PROGRESS_INTERVAL):
+        return
+    show_progress.last = now
+    show_progress.last_percent = progress.percent
+
+    bar = _BARS[_BAR_LEN * progress.percent // 100]
     eta = f"{progress.eta:.0f}s" if progress.eta > 0 else "calculating"
     out = f"\r[{bar}] {progress.percent:3d}% | {progress.run:.1f}s | {eta} left"
-    print(out[:80], end="", flush=True)
+    sys.stdout.write(out[:80])
+    sys.stdout.flush()
 
 
-def process_image(src, artworks_dir, cleanup=False, original_name=None):
+show_progress.last = 0.0
+show_progress.last_percent = -1
+
+
+def process_image(src, artworks_dir, cleanup=False, original_name=None,
+                  tile_size=DEFAULT_TILE_SIZE, container=DEFAULT_CONTAINER):
     """
     Convert an image file to DZI and return artwork metadata dict.
     Keeps the original image for crop export.
@@ -87,42 +165,47 @@ def process_image(src, artworks_dir, cleanup=False, original_name=None):
 
     dzi_dir.mkdir(exist_ok=True)
 
-    # keep original for crop export
     original_ext = src.suffix or ".jpg"
-    original_dest = _safe_path(dzi_dir, f"original{original_ext}")
-    original_dest.write_bytes(src.read_bytes())
-
-    # also copy for processing if pyvips needs it in a specific place
-    working_copy = _safe_path(dzi_dir, src.name)
-    working_copy.write_bytes(src.read_bytes())
-
     try:
+        # keep original for crop export
+        original_dest = _safe_path(dzi_dir, f"original{original_ext}")
+        _copy_file(src, original_dest)
+
+        # pyvips streams the source by path, no working copy needed
         if HAS_PYVIPS:
-            _convert_with_pyvips(working_copy, dzi_dir, slug)
+            _convert_with_pyvips(src, dzi_dir, slug, tile_size, container)
         else:
             print("\npyvips not found, falling back to vips CLI (no progress bar)...")
-            _convert_with_cli(working_copy, dzi_dir, slug)
+            _convert_with_cli(src, dzi_dir, slug, tile_size, container)
 
-        get_or_generate_thumbnail(slug, artworks_dir)
+        # the server only serves thumbnails, it never generates them
+        if not get_or_generate_thumbnail(slug, artworks_dir, source=original_dest):
+            raise RuntimeError("thumbnail generation failed")
 
         dzi_file = dzi_dir / f"{slug}.dzi"
         _save_metadata(slug, original_name, dzi_file, artworks_dir)
-
-        return {
-            "name": original_name,
-            "slug": slug,
-            "path": f"Artworks/{slug}/{slug}.dzi",
-            "thumbnail": f"/api/thumb/{slug}",
-            "original": f"Artworks/{slug}/original{original_ext}",
-        }
-
-    finally:
-        working_copy.unlink(missing_ok=True)
-        if cleanup:
-            src.unlink(missing_ok=True)
+    except BaseException:
+        # the gallery is built from a directory scan, so a half-made folder
+        # would show up as a broken artwork and hold on to the slug. src is
+        # left alone: with the folder gone it's the only copy of the image.
+        shutil.rmtree(dzi_dir, ignore_errors=True)
+        raise
+
+    # only once the artwork is complete, never after a rollback
+    if cleanup:
+        src.unlink(missing_ok=True)
+
+    return {
+        "name": original_name,
+        "slug": slug,
+        "path": f"Artworks/{slug}/{slug}.dzi",
+        "thumbnail": f"/api/thumb/{slug}",
+        "original": f"Artworks/{slug}/original{original_ext}",
+    }
 
 
-def convert_to_dzi(image_path, cleanup=False):
+def convert_to_dzi(image_path, cleanup=False, tile_size=DEFAULT_TILE_SIZE,
+                   container=DEFAULT_CONTAINER):
     """CLI-facing wrapper around process_image()."""
     src = Path(image_path).resolve()
     artworks_dir = Path(__file__).parent / "Artworks"
@@ -133,9 +216,13 @@ def convert_to_dzi(image_path, cleanup=False):
     if not HAS_PYVIPS:
         print("\npyvips not found, falling back to vips CLI (no progress bar)...")
 
-    result = process_image(src, artworks_dir, cleanup=cleanup)
+    start = time.monotonic()
+    result = process_image(src, artworks_dir, cleanup=cleanup, tile_size=tile_size,
+                           container=container)
+    elapsed = time.monotonic() - start
 
     print(f"\n✓ DZI created at {_safe_path(artworks_dir, result['slug'])}/")
+    print(f"✓ Converted in {elapsed:.1f}s ({tile_size}px tiles)")
     print("✓ Original kept for crop export")
     print("✓ Thumbnail ready")
     if cleanup:
@@ -144,7 +231,7 @@ def convert_to_dzi(image_path, cleanup=False):
     return result
 
 
-def _convert_with_pyvips(image_path, dzi_dir, slug):
+def _convert_with_pyvips(image_path, dzi_dir, slug, tile_size, container):
     image = pyvips.Image.new_from_file(str(image_path), access="sequential")
     image.set_progress(True)
     image.signal_connect("eval", show_progress)
@@ -153,51 +240,106 @@ def _convert_with_pyvips(image_path, dzi_dir, slug):
     image.dzsave(
         output,
         layout="dz",
-        tile_size=256,
+        tile_size=tile_size,
         overlap=1,
         suffix=".jpg[Q=95]",
+        container=container,
     )
 
+    if container == "zip":
+        if not (dzi_dir / f"{slug}.zip").exists():
+            raise RuntimeError("dzsave didn't produce a .zip file")
+        return
     if not (dzi_dir / f"{slug}.dzi").exists():
         raise RuntimeError("dzsave didn't produce a .dzi file")
     if not (dzi_dir / f"{slug}_files").exists():
         raise RuntimeError("dzsave didn't produce a tile directory")
 
 
-def _convert_with_cli(image_path, dzi_dir, slug):
+def _convert_with_cli(image_path, dzi_dir, slug, tile_size, container):
     subprocess.run(
         [
             "vips", "dzsave", str(image_path), str(dzi_dir / slug),
             "--layout", "dz",
-            "--tile-size", "256",
+            "--tile-size", str(tile_size),
             "--overlap", "1",
             "--suffix", ".jpg[Q=95]",
+            "--container", container,
         ],
         check=True,
     )
 
 
-def _save_metadata(slug, original_name, dzi_file, artworks_dir):
+@contextmanager
+def _locked_metadata(artworks_dir):
+    """
+    Yield .artworks.json as a dict and write it back on exit.
+    Locked so concurrent conversions don't lose entries, replaced atomically
+    so readers never see a half-written file.
+    """
+    artworks_dir = Path(artworks_dir)
     metadata_file = artworks_dir / ".artworks.json"
 
-    metadata = {}
-    if metadata_file.exists():
-        try:
-            metadata = json.loads(metadata_file.read_text())
-        except Exception:
-            pass
+    with open(artworks_dir / ".artworks.lock", "a") as lock:
+        if fcntl:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
 
-    metadata[slug] = {
-        "original_name": original_name,
-    }
+        metadata = {}
+        if metadata_file.exists():
+            try:
+                metadata = _loads(metadata_file.read_bytes())
+            except Exception:
+                pass
+
+        yield metadata
+
+        tmp = metadata_file.with_name(metadata_file.name + ".tmp")
+        tmp.write_bytes(_dumps_pretty(metadata))
+        os.replace(tmp, metadata_file)
+
+
+def _loads(data):
+    return orjson.loads(data) if orjson else json.loads(data)
 
-    metadata_file.write_text(json.dumps(metadata, indent=2))
+
+def _dumps_pretty(data):
+    if orjson:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2)
+    return json.dumps(data, indent=2).encode()
+
+
+def _save_metadata(slug, original_name, dzi_file, artworks_dir):
+    with _locked_metadata(artworks_dir) as metadata:
+        metadata[slug] = {
+            "original_name": original_name,
+        }
+
+
+def remove_artwork_metadata(slug, artworks_dir):
+    with _locked_metadata(artworks_dir) as metadata:
+        metadata.pop(slug, None)
+
+
+def _tile_size_arg(value):
+    """argparse type for --tile-size: an int dzsave will accept."""
+    try:
+        size = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid tile size: {value!r}")
+    if not 1 <= size <= MAX_TILE_SIZE:
+        raise argparse.ArgumentTypeError(f"tile size must be between 1 and {MAX_TILE_SIZE}")
+    return size
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Convert images to DZI format")
     parser.add_argument("image", help="path to the image")
     parser.add_argument("--cleanup", action="store_true", help="remove original after conversion")
+    parser.add_argument("--tile-size", type=_tile_size_arg, default=DEFAULT_TILE_SIZE,
+                        help=f"DZI tile size in pixels (default {DEFAULT_TILE_SIZE})")
+    parser.add_argument("--container", choices=CONTAINERS, default=DEFAULT_CONTAINER,
+                        help=f"tile storage (default {DEFAULT_CONTAINER})")
     args = parser.parse_args()
 
-    convert_to_dzi(args.image, cleanup=args.cleanup)
+    convert_to_dzi(args.image, cleanup=args.cleanup, tile_size=args.tile_size,
+                   container=args.container)
@@ -4,23 +4,171 @@ Art Gallery Server — hardened, minimal, serves DZI tiles and handles
 curatorial operations: annotations, crop export, upload conversion.
 """
 
+import datetime
+import email.utils
+import gzip
 import io
 import json
 import os
 import re
 import tempfile
+import threading
 import time
+import zipfile
+from collections import OrderedDict
 from pathlib import Path
-from http.server import HTTPServer, SimpleHTTPRequestHandler
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
 from urllib.parse import urlparse, unquote
 
-from thumb_utils import get_or_generate_thumbnail
-from convert_to_dzi import process_image
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# convert_to_dzi first: it sets the libvips environment before pyvips loads
+from convert_to_dzi import process_image, remove_artwork_metadata
+from thumb_utils import probe_thumbnail
 
 PORT = 8000
 MAX_UPLOAD = 5 * 1024 * 1024 * 1024  # it's currently 5GB, but this can be customized.
 UPLOAD_COOLDOWN = 2.0
 
+# /api/artworks payload, rebuilt only when Artworks/ or .artworks.json change.
+# "generation" is bumped on every explicit invalidation so a rebuild that
+# started before it (and may have read stale annotations) is never published.
+_ARTWORKS_CACHE = {"key": None, "payload": None, "gzip": None, "generation": 0}
+_ARTWORKS_LOCK = threading.Lock()
+
+
+def _invalidate_artworks_cache():
+    with _ARTWORKS_LOCK:
+        _ARTWORKS_CACHE["generation"] += 1
+        _ARTWORKS_CACHE["key"] = None
+
+
+def _accepts_gzip(accept_encoding):
+    # honour q-values: "gzip;q=0" is an explicit refusal
+    for part in accept_encoding.split(','):
+        coding, _, params = part.partition(';')
+        if coding.strip().lower() not in ('gzip', 'x-gzip'):
+            continue
+        for param in params.split(';'):
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+
+def _dumps(data):
+    # API responses are only read by app.js, no need for indentation
+    if orjson:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(',', ':')).encode()
+
+
+# DZI paths that may live inside an artwork's {slug}.zip instead of on disk
+_ARCHIVE_PATH = re.compile(r'^/Artworks/([\w-]+)/(\1(?:\.dzi|_files/\d+/\d+_\d+\.\w+))$')
+MAX_OPEN_ARCHIVES = 32
+
+# Tiles only change if an artwork is deleted and its slug reused, so let
+# browsers keep them for a while and revalidate with Last-Modified after.
+TILE_CACHE_CONTROL = 'public, max-age=3600'
+
+# slug -> (ZipFile, st_ino, st_mtime_ns) of its {slug}.zip, least recently
+# used first. Every hit is checked against a fresh stat so an archive that
+# was deleted or replaced outside the API is never served. Evicted handles
+# are left for the GC to close since another thread may still be reading.
+_ARCHIVES = OrderedDict()
+# slug -> artwork folder mtime_ns when it was last seen without a readable
+# zip, so fs-layout artworks don't retry the open on every tile. Any change
+# to the folder (dzsave finishing, the thumbnail landing) clears it.
+_NO_ARCHIVE = {}
+_ARCHIVES_LOCK = threading.Lock()
+
+
+def _open_archive(artworks_dir, slug):
+    """Return (ZipFile, mtime_ns) for the artwork's zip container, or None."""
+    # slug is [\w-]+ (see _ARCHIVE_PATH), so a plain join can't escape
+    artwork_dir = os.path.join(artworks_dir, slug)
+    zip_path = os.path.join(artwork_dir, f'{slug}.zip')
+
+    with _ARCHIVES_LOCK:
+        entry = _ARCHIVES.get(slug)
+        missing_mtime = _NO_ARCHIVE.get(slug)
+
+    if entry is not None:
+        zf, ino, mtime = entry
+        try:
+            st = os.stat(zip_path)
+        except OSError:
+            st = None
+        if st is not None and (st.st_ino, st.st_mtime_ns) == (ino, mtime):
+            with _ARCHIVES_LOCK:
+                if slug in _ARCHIVES:
+                    _ARCHIVES.move_to_end(slug)
+            return zf, mtime
+        with _ARCHIVES_LOCK:
+            if _ARCHIVES.get(slug) is entry:
+                del _ARCHIVES[slug]
+
+    try:
+        dir_mtime = os.stat(artwork_dir).st_mtime_ns
+    except OSError:
+        return None
+    if dir_mtime == missing_mtime:
+        return None
+
+    try:
+        zf = zipfile.ZipFile(zip_path)
+        st = os.fstat(zf.fp.fileno())
+    except (OSError, zipfile.BadZipFile):
+        with _ARCHIVES_LOCK:
+            _NO_ARCHIVE[slug] = dir_mtime
+        return None
+
+    with _ARCHIVES_LOCK:
+        _NO_ARCHIVE.pop(slug, None)
+        _ARCHIVES[slug] = (zf, st.st_ino, st.st_mtime_ns)
+        _ARCHIVES.move_to_end(slug)
+        while len(_ARCHIVES) > MAX_OPEN_ARCHIVES:
+            _ARCHIVES.popitem(last=False)
+    return zf, st.st_mtime_ns
+
+
+def _forget_archive(slug):
+    with _ARCHIVES_LOCK:
+        _ARCHIVES.pop(slug, None)
+        _NO_ARCHIVE.pop(slug, None)
+
+
+THUMB_SIZE = 400
+THUMB_CACHE_ENTRIES = 256
+THUMB_CACHE_MAX_BYTES = 64 * 1024
+
+# (slug, size, mtime_ns) -> jpeg bytes, least recently used first. The mtime
+# in the key means a regenerated thumbnail is never served stale.
+_THUMB_BYTES = OrderedDict()
+_THUMB_LOCK = threading.Lock()
+
+
+def _cached_thumbnail(key):
+    with _THUMB_LOCK:
+        payload = _THUMB_BYTES.get(key)
+        if payload is not None:
+            _THUMB_BYTES.move_to_end(key)
+        return payload
+
+
+def _cache_thumbnail(key, payload):
+    with _THUMB_LOCK:
+        _THUMB_BYTES[key] = payload
+        while len(_THUMB_BYTES) > THUMB_CACHE_ENTRIES:
+            _THUMB_BYTES.popitem(last=False)
+
 
 def _extract_boundary(content_type):
     m = re.search(r'boundary=([^;\s]+)', content_type)
@@ -99,7 +247,20 @@ def _safe_path(base_dir, *parts):
 
 
 class SmartDZIHandler(SimpleHTTPRequestHandler):
+    SCRIPT_DIR = Path(__file__).resolve().parent
+    ARTWORKS_DIR = SCRIPT_DIR / 'Artworks'
+    CORS_ORIGIN = '*'
+    CORS_METHODS = 'GET, POST, DELETE, OPTIONS'
+    _EMPTY_JSON = b'[]'
+
+    # keep-alive, so a gallery load reuses one connection for the listing and
+    # its thumbnails. Every response must carry a Content-Length (or close).
+    protocol_version = 'HTTP/1.1'
+    # don't let idle keep-alive connections hold a thread forever
+    timeout = 30
+
     _last_upload = 0.0
+    _upload_lock = threading.Lock()
 
     def version_string(self):
         return "art-viewer"
@@ -119,6 +280,8 @@ class SmartDZIHandler(SimpleHTTPRequestHandler):
             slug = path.replace('/api/annotations/', '')
             self.send_annotations(slug)
             return
+        if self.send_archive_member(path):
+            return
         if path == '/':
             self.path = '/index.html'
 
@@ -173,11 +336,14 @@ class SmartDZIHandler(SimpleHTTPRequestHandler):
             self.send_json({"error": "file too large (max 5GB)"}, status=413)
             return
 
-        now = time.time()
-        if now - SmartDZIHandler._last_upload < UPLOAD_COOLDOWN:
+        with SmartDZIHandler._upload_lock:
+            now = time.time()
+            throttled = now - SmartDZIHandler._last_upload < UPLOAD_COOLDOWN
+            if not throttled:
+                SmartDZIHandler._last_upload = now
+        if throttled:
             self.send_json({"error": "please wait before uploading again"}, status=429)
             return
-        SmartDZIHandler._last_upload = now
 
         boundary = _extract_boundary(content_type)
         if not boundary:
@@ -208,10 +374,9 @@ class SmartDZIHandler(SimpleHTTPRequestHandler):
                 tmp.write(data)
                 tmp_path = tmp.name
 
-            artworks_dir = Path(__file__).parent / 'Artworks'
             # derive a clean name from the original filename
             original_name = Path(filename).stem
-            result = process_image(tmp_path, artworks_dir, original_name=original_name)
+            result = process_image(tmp_path, self.ARTWORKS_DIR, original_name=original_name)
             self.send_json(result, status=200)
         except Exception as e:
             self.send_json({"error": str(e)}, status=500)
@@ -221,7 +386,7 @@ class SmartDZIHandler(SimpleHTTPRequestHandler):
 
     def send_annotations(self, slug):
         try:
-            ann_file = _safe_path(Path(__file__).parent / 'Artworks', slug, 'annotations.json')
+            ann_file = _safe_path(self.ARTWORKS_DIR, slug, 'annotations.json')
             if ann_file.exists():
                 self.send_json(json.loads(ann_file.read_text()))
             else:
@@ -244,8 +409,9 @@ class SmartDZIHandler(SimpleHTTPRequestHandler):
             return
 
         try:
-            ann_file = _safe_path(Path(__file__).parent / 'Artworks', slug, 'annotations.json')
+            ann_file = _safe_path(self.ARTWORKS_DIR, slug, 'annotations.json')
             ann_file.write_text(json.dumps(data, indent=2))
+            _invalidate_artworks_cache()
             self.send_json({"ok": True})
         except Exception as e:
             self.send_json({"error": str(e)}, status=500)
@@ -273,7 +439,7 @@ class SmartDZIHandler(SimpleHTTPRequestHandler):
             return
 
         try:
-            artwork_dir = _safe_path(Path(__file__).parent / 'Artworks', slug)
+            artwork_dir = _safe_path(self.ARTWORKS_DIR, slug)
             original = None
             for ext in ['.jpg', '.jpeg', '.png', '.tif', '.tiff', '.webp']:
                 candidate = artwork_dir / f'original{ext}'
@@ -287,7 +453,9 @@ class SmartDZIHandler(SimpleHTTPRequestHandler):
 
             try:
                 import pyvips
-                img = pyvips.Image.new_from_file(str(original))
+                # one top-to-bottom pass is all a crop needs, so stream it
+                # instead of decoding the whole original up front
+                img = pyvips.Image.new_from_file(str(original), access='sequential')
                 crop = img.crop(x, y, w, h)
                 buf = crop.write_to_buffer('.jpg[Q=92]')
                 self.send_response(200)
@@ -304,25 +472,23 @@ class SmartDZIHandler(SimpleHTTPRequestHandler):
 
     def handle_delete_artwork(self, slug):
         try:
-            artwork_dir = _safe_path(Path(__file__).parent / 'Artworks', slug)
+            artwork_dir = _safe_path(self.ARTWORKS_DIR, slug)
             if not artwork_dir.exists():
                 self.send_json({"error": "artwork not found"}, status=404)
                 return
 
             import shutil
+            _forget_archive(slug)
             shutil.rmtree(str(artwork_dir), ignore_errors=True)
+            # a tile request may have reopened the zip mid-delete
+            _forget_archive(slug)
 
-            artworks_dir = Path(__file__).parent / 'Artworks'
-            metadata_file = artworks_dir / '.artworks.json'
-            if metadata_file.exists():
-                try:
-                    metadata = json.loads(metadata_file.read_text())
-                    if slug in metadata:
-                        del metadata[slug]
-                        metadata_file.write_text(json.dumps(metadata, indent=2))
-                except Exception:
-                    pass
+            try:
+                remove_artwork_metadata(slug, self.ARTWORKS_DIR)
+            except Exception:
+                pass
 
+            _invalidate_artworks_cache()
             self.send_json({"ok": True})
         except Exception as e:
             self.send_json({"error": str(e)}, status=500)
@@ -333,101 +499,224 @@ class SmartDZIHandler(SimpleHTTPRequestHandler):
 
         if path.startswith('/api/thumb/'):
             slug = path.replace('/api/thumb/', '')
-            artworks_dir = Path(__file__).parent / 'Artworks'
-            thumb_path = get_or_generate_thumbnail(slug, artworks_dir)
-
-            if thumb_path and Path(thumb_path).exists():
-                self.send_response(200)
-                self.send_header('Content-Type', 'image/jpeg')
-                self.send_header('Content-Length', str(Path(thumb_path).stat().st_size))
-                self.end_headers()
-            else:
-                self.send_response(404)
-                self.end_headers()
+            self.send_thumbnail(slug, head=True)
+            return
+        if self.send_archive_member(path, head=True):
             return
 
         super().do_HEAD()
 
     def send_artworks(self):
-        artworks = []
-        script_dir = Path(__file__).parent
-        artworks_dir = script_dir / 'Artworks'
+        artworks_dir = self.ARTWORKS_DIR
+        metadata_file = artworks_dir / '.artworks.json'
+        generation = _ARTWORKS_CACHE["generation"]
 
-        if not artworks_dir.exists():
-            self.send_json([])
+        try:
+            dir_mtime = artworks_dir.stat().st_mtime_ns
+        except OSError:
+            self.send_json_bytes(self._EMPTY_JSON)
+            return
+        try:
+            metadata_mtime = metadata_file.stat().st_mtime_ns
+        except OSError:
+            metadata_mtime = None
+
+        key = (dir_mtime, metadata_mtime)
+        wants_gzip = _accepts_gzip(self.headers.get('Accept-Encoding', ''))
+        if _ARTWORKS_CACHE["key"] == key:
+            if wants_gzip:
+                self.send_json_bytes(_ARTWORKS_CACHE["gzip"], encoding='gzip')
+            else:
+                self.send_json_bytes(_ARTWORKS_CACHE["payload"])
             return
 
-        metadata_file = artworks_dir / '.artworks.json'
         metadata = {}
-        if metadata_file.exists():
+        if metadata_mtime is not None:
             try:
                 metadata = json.loads(metadata_file.read_text())
             except Exception:
                 pass
 
-        for item in sorted(artworks_dir.iterdir()):
-            if not item.is_dir() or item.name.startswith('.'):
+        # scandir hands back d_type with each entry, and listing an artwork's
+        # folder answers the .dzi/.zip/annotations checks without a stat each
+        with os.scandir(artworks_dir) as it:
+            entries = sorted(
+                (e for e in it if not e.name.startswith('.') and e.is_dir()),
+                key=lambda e: e.name,
+            )
+
+        artworks = []
+        for entry in entries:
+            slug = entry.name
+            try:
+                with os.scandir(entry.path) as it:
+                    names = {e.name for e in it}
+            except OSError:
                 continue
 
-            dzi_file = item / f'{item.name}.dzi'
-            if not dzi_file.exists():
+            if f'{slug}.dzi' not in names and f'{slug}.zip' not in names:
                 continue
 
-            original_name = metadata.get(item.name, {}).get('original_name', item.name)
+            original_name = metadata.get(slug, {}).get('original_name', slug)
 
             ann_count = 0
-            ann_file = item / 'annotations.json'
-            if ann_file.exists():
+            if 'annotations.json' in names:
                 try:
-                    ann_data = json.loads(ann_file.read_text())
+                    with open(os.path.join(entry.path, 'annotations.json')) as f:
+                        ann_data = json.load(f)
                     ann_count = len(ann_data.get('annotations', []))
                 except Exception:
                     pass
 
             artworks.append({
                 'name': original_name,
-                'slug': item.name,
-                'path': f'Artworks/{item.name}/{item.name}.dzi',
-                'thumbnail': f'/api/thumb/{item.name}',
+                'slug': slug,
+                'path': f'Artworks/{slug}/{slug}.dzi',
+                'thumbnail': f'/api/thumb/{slug}',
                 'annotations': ann_count
             })
 
-        self.send_json(artworks)
+        payload = _dumps(artworks)
+        # level 1 already gets most of the win on this repetitive JSON
+        compressed = gzip.compress(payload, compresslevel=1)
+        with _ARTWORKS_LOCK:
+            if _ARTWORKS_CACHE["generation"] == generation:
+                # payloads first: cache hits read without the lock and must
+                # never pair the new key with an old payload
+                _ARTWORKS_CACHE["payload"] = payload
+                _ARTWORKS_CACHE["gzip"] = compressed
+                _ARTWORKS_CACHE["key"] = key
+        if wants_gzip:
+            self.send_json_bytes(compressed, encoding='gzip')
+        else:
+            self.send_json_bytes(payload)
+
+    def send_archive_member(self, path, head=False):
+        """Serve a .dzi or tile out of the artwork's zip container, if it has one."""
+        m = _ARCHIVE_PATH.match(path)
+        if not m:
+            return False
+        slug, name = m.groups()
+        archive = _open_archive(self.ARTWORKS_DIR, slug)
+        if archive is None:
+            return False
+        zf, mtime_ns = archive
+
+        try:
+            # dzsave nests everything under a directory named after the slug
+            info = zf.getinfo(f'{slug}/{name}')
+        except KeyError:
+            self.send_error(404, "File not found")
+            return True
+
+        mtime = mtime_ns / 1e9
+        if self._not_modified_since(mtime):
+            self.send_response(304)
+            self.send_header('Last-Modified', self.date_time_string(mtime))
+            self.send_header('Cache-Control', TILE_CACHE_CONTROL)
+            self.end_headers()
+            return True
+
+        data = b'' if head else zf.read(info)
+        self.send_response(200)
+        self.send_header('Content-Type', self.guess_type(name))
+        self.send_header('Content-Length', str(info.file_size))
+        self.send_header('Last-Modified', self.date_time_string(mtime))
+        self.send_header('Cache-Control', TILE_CACHE_CONTROL)
+        self.end_headers()
+        if not head:
+            try:
+                self.wfile.write(data)
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+        return True
 
-    def send_thumbnail(self, slug):
-        artworks_dir = Path(__file__).parent / 'Artworks'
-        thumb_path = get_or_generate_thumbnail(slug, artworks_dir)
+    def _not_modified_since(self, mtime):
+        # same rules as SimpleHTTPRequestHandler.send_head for static files
+        if 'If-Modified-Since' not in self.headers or 'If-None-Match' in self.headers:
+            return False
+        try:
+            ims = email.utils.parsedate_to_datetime(self.headers['If-Modified-Since'])
+        except (TypeError, IndexError, OverflowError, ValueError):
+            return False
+        if ims.tzinfo is None:
+            ims = ims.replace(tzinfo=datetime.timezone.utc)
+        if ims.tzinfo is not datetime.timezone.utc:
+            return False
+        last_modified = datetime.datetime.fromtimestamp(mtime, datetime.timezone.utc)
+        return last_modified.replace(microsecond=0) <= ims
+
+    def send_thumbnail(self, slug, head=False):
+        # thumbnails are made at conversion time, the server never runs pyvips
+        # for them (backfill older artworks with `python3 thumb_utils.py`)
+        probe = probe_thumbnail(slug, self.ARTWORKS_DIR, THUMB_SIZE)
+        if probe is None:
+            if head:
+                self.send_error(404, 'thumbnail not found')
+            else:
+                self.send_json({'error': 'thumbnail not found'}, status=404)
+            return
+        thumb_path, st = probe
 
-        if thumb_path and Path(thumb_path).exists():
+        if head:
             self.send_response(200)
             self.send_header('Content-Type', 'image/jpeg')
+            self.send_header('Content-Length', str(st.st_size))
             self.send_header('Cache-Control', 'public, max-age=31536000')
-            self.send_header('Access-Control-Allow-Origin', '*')
             self.end_headers()
-            with open(thumb_path, 'rb') as f:
-                self.wfile.write(f.read())
             return
 
-        self.send_json({'error': 'thumbnail not found'}, status=404)
+        key = (slug, THUMB_SIZE, st.st_mtime_ns)
+        payload = _cached_thumbnail(key)
+        if payload is None and st.st_size <= THUMB_CACHE_MAX_BYTES:
+            payload = thumb_path.read_bytes()
+            _cache_thumbnail(key, payload)
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(payload) if payload is not None else st.st_size))
+        self.send_header('Cache-Control', 'public, max-age=31536000')
+        self.end_headers()
+        try:
+            if payload is not None:
+                self.wfile.write(payload)
+            else:
+                # headers are flushed by end_headers, so the body can go
+                # straight from the page cache to the socket
+                with open(thumb_path, 'rb') as f:
+                    self.connection.sendfile(f)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
 
     def send_json(self, data, status=200):
+        self.send_json_bytes(_dumps(data), status=status)
+
+    def send_json_bytes(self, payload, status=200, encoding=None):
         self.send_response(status)
         self.send_header('Content-Type', 'application/json')
-        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Content-Length', str(len(payload)))
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+            self.send_header('Vary', 'Accept-Encoding')
+        if status >= 400:
+            # the request body may not have been read, so the connection
+            # can't be reused for the next request
+            self.send_header('Connection', 'close')
         self.end_headers()
         try:
-            self.wfile.write(json.dumps(data, indent=2).encode())
+            self.wfile.write(payload)
         except (BrokenPipeError, ConnectionResetError):
             pass
 
     def end_headers(self):
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST, DELETE, OPTIONS')
+        # CORS headers go out on every response, including static files
+        self.send_header('Access-Control-Allow-Origin', self.CORS_ORIGIN)
+        self.send_header('Access-Control-Allow-Methods', self.CORS_METHODS)
         super().end_headers()
 
 
 if __name__ == '__main__':
-    os.chdir(Path(__file__).parent)
+    os.chdir(SmartDZIHandler.SCRIPT_DIR)
 
     print("Art Gallery Server")
     print("=" * 20)
@@ -438,7 +727,7 @@ if __name__ == '__main__':
     print("Press Ctrl+C to stop")
     print()
 
-    with HTTPServer(("127.0.0.1", PORT), SmartDZIHandler) as httpd:
+    with ThreadingHTTPServer(("127.0.0.1", PORT), SmartDZIHandler) as httpd:
         try:
             httpd.serve_forever()
         except KeyboardInterrupt:
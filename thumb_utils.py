@@ -4,8 +4,11 @@ Thumbnail generator — uses the original image (kept for crop export).
 pyvips thumbnail is shrink-on-load efficient for large images.
 """
 
-import json
+import os
 import re
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
+from multiprocessing import get_context
 from pathlib import Path
 
 try:
@@ -14,6 +17,9 @@ try:
 except ImportError:
     HAS_PYVIPS = False
 
+# anything smaller is treated as corrupt and regenerated
+MIN_THUMB_BYTES = 1024
+
 
 def _safe_path(base_dir, *parts):
     base = Path(base_dir).resolve()
@@ -25,7 +31,21 @@ def _safe_path(base_dir, *parts):
     return target
 
 
-def get_or_generate_thumbnail(artwork_slug, artworks_dir, size=400):
+def _find_original(artwork_path):
+    # process_image keeps the upload's own suffix (original.JPG, original.gif,
+    # ...), so match case-insensitively and accept whatever it kept
+    try:
+        names = [n for n in os.listdir(artwork_path) if Path(n).stem == "original"]
+    except OSError:
+        return None
+    by_ext = {Path(n).suffix.lower(): n for n in names}
+    for ext in (".jpg", ".jpeg", ".png", ".webp", ".tif", ".tiff"):
+        if ext in by_ext:
+            return artwork_path / by_ext[ext]
+    return artwork_path / sorted(names)[0] if names else None
+
+
+def get_or_generate_thumbnail(artwork_slug, artworks_dir, size=400, source=None):
     if not artwork_slug or not re.match(r"^[\w-]+$", artwork_slug):
         return None
 
@@ -34,31 +54,26 @@ def get_or_generate_thumbnail(artwork_slug, artworks_dir, size=400):
     thumb_path = _safe_path(artwork_path, f".thumb-{size}.jpg")
 
     # always regenerate if suspiciously small | IT HAPPENED BECAUSE OF THE SOLID COLOUR CORRUPTION
-    if thumb_path.exists() and thumb_path.stat().st_size > 1024:
+    if thumb_path.exists() and thumb_path.stat().st_size > MIN_THUMB_BYTES:
         return str(thumb_path)
     if thumb_path.exists():
         thumb_path.unlink(missing_ok=True)
 
-    source = None
-    for ext in (".jpg", ".jpeg", ".png", ".webp", ".tif", ".tiff"):
-        candidate = artwork_path / f"original{ext}"
-        if candidate.exists():
-            source = candidate
-            break
-
-    if not source or not source.exists():
+    if source is None:
+        source = _find_original(artwork_path)
+    if not source or not Path(source).exists():
         return None
 
     # make thumbnail quality higher this time, it was tooo blurry before
     try:
         if HAS_PYVIPS:
             pyvips.Image.thumbnail(str(source), size).write_to_file(
-                str(thumb_path), Q=85
+                str(thumb_path), Q=85, strip=True
             )
         else:
             import subprocess
             subprocess.run(
-                ["vips", "thumbnail", str(source), str(thumb_path), str(size)],
+                ["vips", "thumbnail", str(source), f"{thumb_path}[Q=85,strip]", str(size)],
                 check=True, capture_output=True
             )
         return str(thumb_path)
@@ -66,26 +81,96 @@ def get_or_generate_thumbnail(artwork_slug, artworks_dir, size=400):
         return None
 
 
+@lru_cache(maxsize=1024)
+def _thumb_path(artworks_dir, artwork_slug, size):
+    if not artwork_slug or not re.match(r"^[\w-]+$", artwork_slug):
+        return None
+    return _safe_path(artworks_dir, artwork_slug, f".thumb-{size}.jpg")
+
+
+def probe_thumbnail(artwork_slug, artworks_dir, size=400):
+    # a single stat, never generates. (path, stat_result) or None. Only
+    # empty files are rejected: the "too small means corrupt" rule belongs to
+    # get_or_generate_thumbnail, which may legitimately produce a tiny file
+    # for a flat or very elongated work
+    try:
+        thumb_path = _thumb_path(artworks_dir, artwork_slug, size)
+        if thumb_path is None:
+            return None
+        st = thumb_path.stat()
+    except (OSError, RuntimeError):
+        return None
+    if not st.st_size:
+        return None
+    return thumb_path, st
+
+
 def has_thumbnail(artwork_slug, artworks_dir, size=400):
+    return probe_thumbnail(artwork_slug, artworks_dir, size) is not None
+
+
+def _init_thumbnail_worker():
+    # batch workers are short-lived and only make thumbnails, so give the
+    # libvips operation cache more room than its defaults. The long-running
+    # server keeps the defaults: the cache holds source files open.
+    if HAS_PYVIPS:
+        pyvips.cache_set_max(1000)
+        pyvips.cache_set_max_mem(512 * 1024 * 1024)
+        pyvips.cache_set_max_files(500)
+
+
+def _artwork_slugs(artworks_dir):
+    # same rule as the gallery listing in serve.py: any folder holding a
+    # .dzi or .zip pyramid, whether or not .artworks.json knows about it
     try:
-        thumb_path = _safe_path(artworks_dir, artwork_slug, f".thumb-{size}.jpg")
-        return thumb_path.exists() and thumb_path.stat().st_size > 1024
-    except Exception:
-        return False
+        with os.scandir(artworks_dir) as it:
+            entries = [e for e in it if not e.name.startswith(".") and e.is_dir()]
+    except OSError:
+        return []
+
+    slugs = []
+    for entry in sorted(entries, key=lambda e: e.name):
+        try:
+            with os.scandir(entry.path) as it:
+                names = {e.name for e in it}
+        except OSError:
+            continue
+        if f"{entry.name}.dzi" in names or f"{entry.name}.zip" in names:
+            slugs.append(entry.name)
+    return slugs
 
 
-def update_metadata_with_thumbnails(artworks_dir):
+def update_metadata_with_thumbnails(artworks_dir, max_workers=None):
     artworks_dir = Path(artworks_dir)
-    metadata_file = artworks_dir / ".artworks.json"
+    slugs = _artwork_slugs(artworks_dir)
+    if len(slugs) < 2:
+        return {
+            slug: get_or_generate_thumbnail(slug, artworks_dir) is not None
+            for slug in slugs
+        }
+
+    # one libvips thread per worker, the pool already spreads across cores.
+    # libvips reads this when pyvips is imported, so it has to be in the
+    # environment the workers are spawned with (spawn, not fork: forking a
+    # process with live libvips threads isn't safe)
+    previous = os.environ.get("VIPS_CONCURRENCY")
+    os.environ["VIPS_CONCURRENCY"] = "1"
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=get_context("spawn"),
+                                 initializer=_init_thumbnail_worker) as ex:
+            results = ex.map(partial(get_or_generate_thumbnail, artworks_dir=artworks_dir), slugs)
+            return {slug: path is not None for slug, path in zip(slugs, results)}
+    finally:
+        if previous is None:
+            os.environ.pop("VIPS_CONCURRENCY", None)
+        else:
+            os.environ["VIPS_CONCURRENCY"] = previous
 
-    metadata = {}
-    if metadata_file.exists():
-        try:
-            metadata = json.loads(metadata_file.read_text())
-        except Exception:
-            pass
-
-    return {
-        slug: get_or_generate_thumbnail(slug, artworks_dir) is not None
-        for slug in metadata.keys()
-    }
+
+if __name__ == "__main__":
+    # backfill thumbnails for artworks converted before they were made upfront
+    results = update_metadata_with_thumbnails(Path(__file__).parent / "Artworks")
+    missing = sorted(slug for slug, ok in results.items() if not ok)
+    print(f"✓ {len(results) - len(missing)}/{len(results)} thumbnails ready")
+    for slug in missing:
+        print(f"✗ {slug}: thumbnail failed")